@@ -50,23 +50,28 @@ main'
 
 import os
 import traceback
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from django.utils import translation
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from pod.bbb.models import BBB_Meeting as Meeting, Attendee
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import dateutil.parser
 from django.core.mail import mail_admins
 from django.utils import timezone
-from defusedxml import minidom
+from defusedxml import ElementTree as ET
 import urllib.parse
 
 from pod.video.models import Video, Type, get_storage_path_video
 from pod.video_encode_transcript import encode
 from django.contrib.auth.models import User
 
+from django.db import transaction
 from django.db.models import Value
 from django.db.models.functions import Concat
 
@@ -81,6 +86,21 @@ DEFAULT_BBB_PATH = getattr(settings, "DEFAULT_BBB_PATH", "/data/bbb-recorder/med
 if not DEFAULT_BBB_PATH.endswith(os.path.sep):
     DEFAULT_BBB_PATH += os.path.sep
 
+# File where a filesystem watcher (inotify via incron, a bbb-recorder
+# hook...) appends the path of each new file created in DEFAULT_BBB_PATH.
+# When set, this command only processes the files listed in it - and
+# truncates it - instead of walking the whole DEFAULT_BBB_PATH directory
+# at each run. A full walk is still made at the first run, while this
+# file does not exist yet, to sweep pre-existing files.
+DEFAULT_BBB_NEW_FILES_LOG = getattr(settings, "DEFAULT_BBB_NEW_FILES_LOG", "")
+
+# File where the modification time of DEFAULT_BBB_PATH is saved between
+# two runs. When set, the directory walk is entirely skipped - one stat
+# syscall instead of thousands - if DEFAULT_BBB_PATH was not modified
+# since the previous run. Its mtime changes whenever a file is created
+# in or removed from it (bbb-recorder writes the videos at its top level).
+DEFAULT_BBB_MTIME_FILE = getattr(settings, "DEFAULT_BBB_MTIME_FILE", "")
+
 # BigBlueButton or Scalelite server URL, where BBB Web presentation and API are
 BBB_SERVER_URL = getattr(settings, "BBB_SERVER_URL", "https://bbb.univ.fr/")
 # The last caracter of BBB_SERVER_URL must be /
@@ -102,31 +122,33 @@ BBB_NUMBER_DAYS_BEFORE_DELETE = getattr(settings, "BBB_NUMBER_DAYS_BEFORE_DELETE
 # BBB or Scalelite version is 2.3 (useful for recording URL in 2.0 or 2.3 format)
 BBB_VERSION_IS_23 = getattr(settings, "BBB_VERSION_IS_23", False)
 
-# Allowed extensions
-VIDEO_ALLOWED_EXTENSIONS = getattr(
-    settings,
-    "VIDEO_ALLOWED_EXTENSIONS",
-    (
-        "3gp",
-        "avi",
-        "divx",
-        "flv",
-        "m2p",
-        "m4v",
-        "mkv",
-        "mov",
-        "mp4",
-        "mpeg",
-        "mpg",
-        "mts",
-        "wmv",
-        "mp3",
-        "ogg",
-        "wav",
-        "wma",
-        "webm",
-        "ts",
-    ),
+# Allowed extensions (lowercase), as a frozenset for O(1) membership test
+VIDEO_ALLOWED_EXTENSIONS = frozenset(
+    getattr(
+        settings,
+        "VIDEO_ALLOWED_EXTENSIONS",
+        (
+            "3gp",
+            "avi",
+            "divx",
+            "flv",
+            "m2p",
+            "m4v",
+            "mkv",
+            "mov",
+            "mp4",
+            "mpeg",
+            "mpg",
+            "mts",
+            "wmv",
+            "mp3",
+            "ogg",
+            "wav",
+            "wma",
+            "webm",
+            "ts",
+        ),
+    )
 )
 
 # Mode debug (0: False, 1: True)
@@ -134,29 +156,90 @@ DEBUG = getattr(settings, "DEBUG", False)
 # Encode video
 ENCODE_VIDEO = getattr(settings, "ENCODE_VIDEO", "start_encode")
 
+# Number of meeting ids requested per getRecordings call
+BBB_RECORDINGS_BATCH_SIZE = 20
+
+# Number of getRecordings calls made in parallel
+BBB_RECORDINGS_MAX_WORKERS = 8
+
+# Timeout (connect, read) in seconds of the requests made to the BBB API,
+# to avoid to hang this command indefinitely on a stuck server
+BBB_REQUEST_TIMEOUT = (3.05, 15)
+
+# Checksum of the getMeetings API call, computed once: constant, since
+# it only depends on BBB_SECRET_KEY
+# See https://docs.bigbluebutton.org/dev/api.html#usage
+# for checksum and security
+GET_MEETINGS_CHECKSUM = hashlib.sha1(
+    str("getMeetings" + BBB_SECRET_KEY).encode("utf-8")
+).hexdigest()
+
+# sha1 template of the getRecordings checksum, with the constant prefix
+# already absorbed: each call only hashes the meeting ids and the
+# secret, on a copy of this object
+GET_RECORDINGS_SHA1 = hashlib.sha1("getRecordingsmeetingID=".encode("utf-8"))
+
+# Session shared by all the requests made to the BBB/Scalelite API,
+# to reuse the same connection (HTTP keep-alive) and to retry
+# automatically on transient server errors
+bbb_session = requests.Session()
+bbb_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+bbb_session.mount("https://", bbb_adapter)
+bbb_session.mount("http://", bbb_adapter)
+
 
 def print_if_debug(str):
     if DEBUG:
         print(str)
 
 
-def encode_file_exist(filename, extension, message_error, html_message_error):
+@dataclass
+class RunContext:
+    """Accumulators shared by all the tasks of one run of this command."""
+
+    errors_txt: list = field(default_factory=list)
+    errors_html: list = field(default_factory=list)
+    # Ids of the videos created during the file walk, to encode once
+    # the walk is over
+    pending_encodes: list = field(default_factory=list)
+
+    def add_error(self, err):
+        # Accumulate the error in the two lists, joined only once at the
+        # end of the run, rather than concatenate strings at each error
+        self.errors_txt.append(err)
+        self.errors_html.append("<li>" + err + "</li>")
+
+
+def encode_file_exist(filename, extension, default_type, owner_cache, ctx):
     # A video file exist in the BBB directory: encode it
     print_if_debug(" - Encode BBB video file: " + filename)
     # Absolute path of the video
     source_file = os.path.join(DEFAULT_BBB_PATH, filename)
 
     # Filename corresponds to: internal_meeting_id.webm
-    internalMeetingId = filename.replace("." + extension, "")
+    internalMeetingId = os.path.splitext(filename)[0]
     # Check if the meeting already exists in Pod database
-    oMeeting = Meeting.objects.filter(internal_meeting_id=internalMeetingId).first()
+    oMeeting = (
+        Meeting.objects.filter(internal_meeting_id=internalMeetingId)
+        .only("id", "meeting_name", "session_date", "encoded_by")
+        .first()
+    )
     if oMeeting:
         # Set video properties with meetng informations
         video = Video()
         video.title = oMeeting.meeting_name
         if oMeeting.encoded_by_id:
-            video.owner = User.objects.get(id=oMeeting.encoded_by_id)
-        video.type = Type.objects.get(id=DEFAULT_BBB_TYPE_ID)
+            # Cache the owners: several files can belong to the same user
+            if oMeeting.encoded_by_id not in owner_cache:
+                owner_cache[oMeeting.encoded_by_id] = User.objects.get(
+                    id=oMeeting.encoded_by_id
+                )
+            video.owner = owner_cache[oMeeting.encoded_by_id]
+        video.type = default_type
         video.date_evt = oMeeting.session_date
         # Video management
         storage_path = get_storage_path_video(video, os.path.basename(source_file))
@@ -170,9 +253,9 @@ def encode_file_exist(filename, extension, message_error, html_message_error):
         os.makedirs(os.path.dirname(video.video.path), exist_ok=True)
         os.rename(source_file, video.video.path)
         video.save()
-        # Encode
-        encode_video = getattr(encode, ENCODE_VIDEO)
-        encode_video(video.id)
+        # Encoded after the walk, not here: a long encoding started
+        # in-process must not stall the processing of the other files
+        ctx.pending_encodes.append(video.id)
     else:
         # Meeting was certainly deleted in Pod database
         print_if_debug(
@@ -181,24 +264,22 @@ def encode_file_exist(filename, extension, message_error, html_message_error):
             "internal_meeting_id: " + internalMeetingId
         )
 
-    return html_message_error, message_error
-
 
-def process_directory(files, root, html_message_error, message_error):
+def process_directory(files, root, default_type, owner_cache, ctx):
+    # Name of the directory
+    dirname = os.path.basename(root)
     # Search files in the BBB directory
     for filename in files:
-        # Name of the directory
-        dirname = root.split(os.path.sep)[-1]
         print_if_debug(
             "\n*** Process the file "
             + os.path.join(DEFAULT_BBB_PATH, dirname, filename)
             + " ***"
         )
         # Check if extension is a good extension (videos extensions)
-        extension = filename.split(".")[-1]
+        # Empty for a file without extension, compared in lowercase
+        extension = os.path.splitext(filename)[1][1:].lower()
 
-        valid_ext = VIDEO_ALLOWED_EXTENSIONS
-        if not (extension in valid_ext and filename != extension):
+        if extension not in VIDEO_ALLOWED_EXTENSIONS:
             print_if_debug(
                 " - WARNING: " + extension + "is not a valid video "
                 "extension. If it should "
@@ -206,77 +287,236 @@ def process_directory(files, root, html_message_error, message_error):
                 "VIDEO_ALLOWED_EXTENSIONS"
             )
             continue
-        html_message_error, message_error = encode_file_exist(
-            filename, extension, message_error, html_message_error
-        )
+        encode_file_exist(filename, extension, default_type, owner_cache, ctx)
+
+
+def walk_bbb_directory(root):
+    # Explicit recursion with os.scandir, rather than os.walk: the
+    # DirEntry objects cache is_file()/is_dir() from the readdir
+    # syscall, where os.walk stats every entry of the directory
+    files = []
+    subdirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # The logs directory of bbb-recorder is ignored
+                if entry.name != "logs":
+                    subdirs.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.name)
+    yield root, files
+    for subdir in subdirs:
+        yield from walk_bbb_directory(subdir)
+
+
+def get_bbb_path_mtime():
+    try:
+        return str(os.stat(DEFAULT_BBB_PATH).st_mtime_ns)
+    except OSError:
+        return None
 
-    return html_message_error, message_error
 
+def read_bbb_path_mtime():
+    # Last known mtime of DEFAULT_BBB_PATH, saved by the previous run
+    try:
+        with open(DEFAULT_BBB_MTIME_FILE) as mtime_file:
+            return mtime_file.read().strip()
+    except OSError:
+        return None
+
+
+def save_bbb_path_mtime(current_mtime):
+    # Save the mtime read before the walk: if files were moved during
+    # the processing, the next run will simply walk once more
+    if DEFAULT_BBB_MTIME_FILE and current_mtime is not None:
+        with open(DEFAULT_BBB_MTIME_FILE, "w") as mtime_file:
+            mtime_file.write(current_mtime)
+
+
+def process_bbb_path(ctx):
+    # Type of the generated videos and owners already seen, fetched only
+    # once for the whole file walk instead of once per video file
+    default_type = Type.objects.get(id=DEFAULT_BBB_TYPE_ID)
+    owner_cache = {}
+    # Check directory to publish video files
+    if DEFAULT_BBB_NEW_FILES_LOG and os.path.exists(DEFAULT_BBB_NEW_FILES_LOG):
+        process_new_files_log(default_type, owner_cache, ctx)
+    else:
+        currentMtime = get_bbb_path_mtime()
+        if DEFAULT_BBB_MTIME_FILE and currentMtime is not None:
+            if currentMtime == read_bbb_path_mtime():
+                print_if_debug(
+                    " - DEFAULT_BBB_PATH not modified since the last "
+                    "run: no file to process."
+                )
+                return
+        # Walk the whole directory: no watcher log configured, or first
+        # run with a watcher log (the file does not exist yet)
+        for root, files in walk_bbb_directory(DEFAULT_BBB_PATH):
+            process_directory(files, root, default_type, owner_cache, ctx)
+        save_bbb_path_mtime(currentMtime)
+        if DEFAULT_BBB_NEW_FILES_LOG:
+            # Create the empty watcher log: the next runs will only
+            # process the files appended to it
+            open(DEFAULT_BBB_NEW_FILES_LOG, "a").close()
+
+    # Encode the videos created, now that all the files were processed
+    encode_video = getattr(encode, ENCODE_VIDEO)
+    for video_id in ctx.pending_encodes:
+        encode_video(video_id)
+
+
+def process_new_files_log(default_type, owner_cache, ctx):
+    # Only process the files recorded by the filesystem watcher since
+    # the previous run, instead of stat'ing every entry of the directory
+    with open(DEFAULT_BBB_NEW_FILES_LOG, "r+") as log:
+        newFiles = [line.strip() for line in log if line.strip()]
+        log.seek(0)
+        log.truncate()
+    filesByDir = {}
+    for path in newFiles:
+        root = os.path.dirname(path) or DEFAULT_BBB_PATH
+        filesByDir.setdefault(root, []).append(os.path.basename(path))
+    for root, files in filesByDir.items():
+        if os.path.basename(root) == "logs":
+            continue
+        process_directory(files, root, default_type, owner_cache, ctx)
 
-def get_bbb_meetings_by_xml(html_message_error, message_error):
+
+def get_bbb_meetings_by_xml(ctx):
     print_if_debug("\n*** Check BBB/Scalelite actual meetings  ***")
     try:
-        # See https://docs.bigbluebutton.org/dev/api.html#usage
-        # for checksum and security
-        checksum = hashlib.sha1(
-            str("getMeetings" + BBB_SECRET_KEY).encode("utf-8")
-        ).hexdigest()
         # Request on BBB/Scalelite server (API)
         # URL example:
         # https://bbb.univ.fr/bigbluebutton/api/getMeetings?checksum=xxxx
         urlToRequest = BBB_SERVER_URL
-        urlToRequest += "bigbluebutton/api/getMeetings?checksum=" + checksum
-        addr = requests.get(urlToRequest)
-        print_if_debug(
-            "Request on URL: " + urlToRequest + ", status: " + str(addr.status_code)
-        )
-        # XML result to parse
-        xmldoc = minidom.parseString(addr.text)
-        returncode = xmldoc.getElementsByTagName("returncode")[0].firstChild.data
+        urlToRequest += "bigbluebutton/api/getMeetings?checksum=" + GET_MEETINGS_CHECKSUM
+        with bbb_session.get(
+            urlToRequest, stream=True, timeout=BBB_REQUEST_TIMEOUT
+        ) as addr:
+            print_if_debug(
+                "Request on URL: " + urlToRequest + ", status: " + str(addr.status_code)
+            )
+            # XML result, parsed as a stream: the body is never
+            # buffered whole in memory beside the parsed tree
+            addr.raw.decode_content = True
+            xmldoc = ET.parse(addr.raw).getroot()
+        returncode = xmldoc.findtext("returncode")
         # Management of FAILED error (basically error in checksum)
         if returncode == "FAILED":
             err = "Return code = FAILED for: " + urlToRequest
-            err += " => : " + xmldoc.toxml() + ""
-            message_error += err + "\n"
-            html_message_error += "<li>" + err + "</li>"
+            err += " => : " + str(xmldoc.findtext("messageKey"))
+            err += " " + str(xmldoc.findtext("message"))
+            ctx.add_error(err)
         # Actual meetings
-        meetings = xmldoc.getElementsByTagName("meeting")
+        meetings = list(xmldoc.iter("meeting"))
+        # Fetch once the meetings and the attendees already known in Pod
+        # database for this meeting list, instead of one query per XML element
+        internalMeetingIDs = [
+            meeting.findtext("internalMeetingID") for meeting in meetings
+        ]
+        existingMeetings = {
+            oMeeting.internal_meeting_id: oMeeting
+            for oMeeting in Meeting.objects.filter(
+                internal_meeting_id__in=internalMeetingIDs
+            ).only("id", "internal_meeting_id", "recorded")
+        }
+        existingAttendees = {
+            (oAttendee.meeting_id, oAttendee.full_name)
+            for oAttendee in Attendee.objects.filter(
+                meeting_id__in=[oMeeting.id for oMeeting in existingMeetings.values()]
+            ).only("meeting", "full_name")
+        }
+        # Update or create the meetings in two bulk queries, instead of
+        # one SELECT plus one INSERT/UPDATE per meeting
+        meetingsToUpdate = []
+        meetingsToCreate = []
         for meeting in meetings:
-            get_meeting(meeting, html_message_error, message_error)
+            get_meeting(
+                meeting,
+                existingMeetings,
+                meetingsToUpdate,
+                meetingsToCreate,
+                ctx,
+            )
+        save_meetings(meetingsToUpdate, meetingsToCreate, existingMeetings)
+
+        # Management of the participants, created in one bulk query too
+        get_attendees(meetings, existingMeetings, existingAttendees, ctx)
 
     except Exception as e:
         err = (
             "Problem to parse XML meetings on the BBB/Scalelite server "
             "or save in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
+
+def save_meetings(meetings_to_update, meetings_to_create, existing_meetings):
+    if meetings_to_update:
+        Meeting.objects.bulk_update(
+            meetings_to_update,
+            ["recorded", "last_date_in_progress"],
+            batch_size=500,
+        )
+    if meetings_to_create:
+        Meeting.objects.bulk_create(meetings_to_create, batch_size=500)
+        # Fetch the created meetings again: bulk_create does not
+        # return the generated ids on all databases
+        existing_meetings.update(
+            {
+                oMeeting.internal_meeting_id: oMeeting
+                for oMeeting in Meeting.objects.filter(
+                    internal_meeting_id__in=[
+                        oMeeting.internal_meeting_id for oMeeting in meetings_to_create
+                    ]
+                )
+            }
+        )
+
+
+def get_attendees(meetings, existing_meetings, existing_attendees, ctx):
+    attendeesToCreate = []
+    for meeting in meetings:
+        oMeeting = existing_meetings.get(meeting.findtext("internalMeetingID"))
+        if oMeeting is None:
+            continue
+        for attendee in meeting.iter("attendee"):
+            get_attendee(
+                attendee,
+                oMeeting.id,
+                existing_attendees,
+                attendeesToCreate,
+                ctx,
+            )
+    if attendeesToCreate:
+        Attendee.objects.bulk_create(attendeesToCreate, batch_size=500)
 
 
-def get_meeting(meeting, html_message_error, message_error):
+def get_meeting(
+    meeting,
+    existing_meetings,
+    meetings_to_update,
+    meetings_to_create,
+    ctx,
+):
     try:
-        # Get meeting informations
-        meetingName = meeting.getElementsByTagName("meetingName")[0].firstChild.data
-        meetingID = meeting.getElementsByTagName("meetingID")[0].firstChild.data
-        internalMeetingID = meeting.getElementsByTagName("internalMeetingID")[
-            0
-        ].firstChild.data
-        date = meeting.getElementsByTagName("createDate")[0].firstChild.data
+        # Get meeting informations: read the child elements once,
+        # instead of one scan of all the children per field
+        info = {child.tag: child.text for child in meeting}
+        meetingName = info.get("meetingName")
+        meetingID = info.get("meetingID")
+        internalMeetingID = info.get("internalMeetingID")
+        date = info.get("createDate")
         # Recording seems useless (~always True)
-        recording = meeting.getElementsByTagName("recording")[0].firstChild.data
+        recording = info.get("recording")
 
         print_if_debug("\n - Meeting: " + internalMeetingID)
 
-        # Id of the current meeting
-        idActualMeeting = 0
         # Search if the meeting already exists in Pod database
-        oMeeting = Meeting.objects.filter(internal_meeting_id=internalMeetingID).first()
+        oMeeting = existing_meetings.get(internalMeetingID)
         if oMeeting:
-            idActualMeeting = oMeeting.id
             print_if_debug("   + Meeting already exists in Pod database.")
             # Check if meeting is recorded now
             if oMeeting.recorded is False and recording == "true":
@@ -285,7 +525,7 @@ def get_meeting(meeting, html_message_error, message_error):
             # In all case, save the last date where BBB session was in progress
             lastDateInProgress = timezone.now()
             oMeeting.last_date_in_progress = lastDateInProgress
-            oMeeting.save()
+            meetings_to_update.append(oMeeting)
         else:
             # Create the meeting in Pod database
             print_if_debug(
@@ -307,44 +547,35 @@ def get_meeting(meeting, html_message_error, message_error):
             else:
                 meetingToCreate.recorded = False
             meetingToCreate.recording_available = False
-            meetingToCreate.save()
-            idActualMeeting = meetingToCreate.id
-
-        # Management of the participants
-        for attendee in meeting.getElementsByTagName("attendee"):
-            get_attendee(attendee, idActualMeeting, html_message_error, message_error)
+            meetings_to_create.append(meetingToCreate)
 
     except Exception as e:
         err = (
             "Problem to get BBB meeting "
             "and save in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
 
-
-def get_attendee(attendee, idActualMeeting, html_message_error, message_error):
+def get_attendee(
+    attendee,
+    idActualMeeting,
+    existing_attendees,
+    attendees_to_create,
+    ctx,
+):
     try:
         # In BigBlueButton, we have only the full name
         # Full name format: "first_name last_name"
-        fullName = attendee.getElementsByTagName("fullName")[0].firstChild.data
-        role = attendee.getElementsByTagName("role")[0].firstChild.data
+        info = {child.tag: child.text for child in attendee}
+        fullName = info.get("fullName")
+        role = info.get("role")
         # We save only the BBB moderator
         if role == "MODERATOR":
             # Search if the BBB user already exists in Pod
-            oAttendee = Attendee.objects.filter(
-                full_name=fullName, meeting_id=idActualMeeting
-            ).first()
-            if oAttendee:
-                print_if_debug(
-                    "   + User already exists "
-                    "in Pod database: "
-                    "" + oAttendee.full_name
-                )
+            if (idActualMeeting, fullName) in existing_attendees:
+                print_if_debug("   + User already exists in Pod database: " + fullName)
             else:
                 # Create the meeting user in Pod database
                 print_if_debug(
@@ -355,27 +586,48 @@ def get_attendee(attendee, idActualMeeting, html_message_error, message_error):
                 attendeeToCreate.role = "MODERATOR"
                 attendeeToCreate.meeting_id = idActualMeeting
 
-                attendeeToCreate.save()
+                attendees_to_create.append(attendeeToCreate)
+                existing_attendees.add((idActualMeeting, fullName))
     except Exception as e:
         err = (
             "Problem to get BBB attendee "
             "and save in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
+
+def index_pod_users_by_name(pod_users):
+    # Index by exact lowercased name: most BBB full names are
+    # exactly the "first_name last_name" of a Pod user
+    podUsersByName = {}
+    for podUser in pod_users:
+        podUsersByName.setdefault(podUser["name"].lower(), podUser)
+    return podUsersByName
+
+
+def find_matching_pod_user(full_name, pod_users, pod_users_by_name):
+    # Take the first one (This can cause an error in case of namesake!)
+    # Exact match first; the substring check - which keeps the former
+    # icontains semantics - is only a fallback for the unmatched names.
+    fullName = full_name.lower()
+    podUser = pod_users_by_name.get(fullName)
+    if podUser is None:
+        podUser = next((u for u in pod_users if fullName in u["name"].lower()), None)
+    return podUser
 
 
-def matching_bbb_pod_user(html_message_error, message_error):
+def matching_bbb_pod_user(ctx):
     print_if_debug("\n*** Search if BBB users matching to Pod users ***")
     try:
         # Search for BBB users already in Pod database, without matching
         # By security: take only the 500 last BBB users, to avoid process
         # too long. Usefull when users are not known in Pod.
-        attendees = Attendee.objects.filter(user_id__isnull=True).order_by("-id")[:500]
+        attendees = (
+            Attendee.objects.filter(user_id__isnull=True)
+            .only("id", "full_name")
+            .order_by("-id")[:500]
+        )
 
         # Use the BBB_USERNAME_FORMAT setting to make the matching.
         if BBB_USERNAME_FORMAT == "last_name first_name":
@@ -383,27 +635,29 @@ def matching_bbb_pod_user(html_message_error, message_error):
         else:
             bbbUsernameFormat = Concat("first_name", Value(" "), "last_name")
 
+        # Fetch the candidate Pod users only once, instead of one
+        # icontains query per BBB user.
+        podUsers = list(
+            User.objects.annotate(name=bbbUsernameFormat).values("id", "username", "name")
+        )
+
+        podUsersByName = index_pod_users_by_name(podUsers)
+
+        attendeesToUpdate = []
         for attendee in attendees:
             # Search if this BBB user matching to a Pod user.
-            # Take the first one (This can cause an error in case of namesake!)
-            podUser = (
-                User.objects.annotate(
-                    name=bbbUsernameFormat,
-                )
-                .filter(name__icontains=attendee.full_name)
-                .first()
-            )
+            podUser = find_matching_pod_user(attendee.full_name, podUsers, podUsersByName)
             if podUser:
                 # Update the id and the username of this user
                 print_if_debug(
                     " - A Pod user matching a BBB user "
                     "was found in Pod database. "
                     "BBB user: " + attendee.full_name + ". "
-                    "Pod user: " + podUser.username
+                    "Pod user: " + podUser["username"]
                 )
-                attendee.username = podUser.username
-                attendee.user_id = podUser.id
-                attendee.save()
+                attendee.username = podUser["username"]
+                attendee.user_id = podUser["id"]
+                attendeesToUpdate.append(attendee)
             else:
                 print_if_debug(
                     " - A Pod user matching a BBB user "
@@ -411,6 +665,12 @@ def matching_bbb_pod_user(html_message_error, message_error):
                     "BBB user: " + attendee.full_name
                 )
 
+        # Save all the BBB users matched, in a single query
+        if attendeesToUpdate:
+            Attendee.objects.bulk_update(
+                attendeesToUpdate, ["username", "user_id"], batch_size=500
+            )
+
     except Exception as e:
         err = (
             "Problem to matching BBB user to Pod user: "
@@ -418,15 +678,11 @@ def matching_bbb_pod_user(html_message_error, message_error):
             + ". "
             + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
 
-
-def get_bbb_meetings_recorded(html_message_error, message_error):
+def get_bbb_meetings_recorded(ctx):
     print_if_debug("\n*** Check BBB meetings recorded in Pod, not already available ***")
 
     try:
@@ -436,132 +692,123 @@ def get_bbb_meetings_recorded(html_message_error, message_error):
         # were deleted or with bad data in the database.
         # For informations: parameter Recorded seems useless (~always True)
         dateSince4d = timezone.now() - timezone.timedelta(days=4)
-        meetings = Meeting.objects.filter(
-            recorded=True,
-            recording_available=False,
-            session_date__gte=dateSince4d,
-        ).order_by("id")
-        for meeting in meetings:
-            # Search recording on BBB/Scalelite server
-            html_message_error, message_error = get_bbb_recording_by_xml(
-                meeting.meeting_id,
-                meeting.internal_meeting_id,
-                html_message_error,
-                message_error,
+        meetings = list(
+            Meeting.objects.filter(
+                recorded=True,
+                recording_available=False,
+                session_date__gte=dateSince4d,
             )
+            .only("id", "meeting_id", "internal_meeting_id")
+            .order_by("id")
+        )
+        # The BBB API accepts a comma-separated list of meeting ids:
+        # search recordings on BBB/Scalelite server by batch of meetings,
+        # instead of one request per meeting.
+        chunks = [
+            meetings[i : i + BBB_RECORDINGS_BATCH_SIZE]
+            for i in range(0, len(meetings), BBB_RECORDINGS_BATCH_SIZE)
+        ]
+        # The HTTP requests, bound by the network latency, are made in
+        # parallel by a small pool of threads; the database writes stay
+        # in the main thread (one database connection).
+        with ThreadPoolExecutor(max_workers=BBB_RECORDINGS_MAX_WORKERS) as executor:
+            futures = [
+                (chunk, executor.submit(fetch_bbb_recordings_xml, chunk))
+                for chunk in chunks
+            ]
+            for chunk, future in futures:
+                get_bbb_recording_by_xml(chunk, future, ctx)
 
     except Exception as e:
         err = (
             "Problem to get recorded meetings "
             "in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
-
-    return html_message_error, message_error
 
 
-def get_bbb_recording_by_xml(
-    meeting_id, internal_meeting_id, html_message_error, message_error
-):
-    print_if_debug(" - Check BBB/Scalelite recording.")
-    try:
-        # See https://docs.bigbluebutton.org/dev/api.html#usage
-        # for checksum and security
-        uri = "getRecordingsmeetingID="
-        uri += urllib.parse.quote_plus(meeting_id) + BBB_SECRET_KEY
-        checksum = hashlib.sha1(str(uri).encode("utf-8")).hexdigest()
-        # Request on BBB/Scalelite server (API)
-        # URL example: https://bbb.univ.fr/bigbluebutton/api/getRecordings?
-        # meetingID=xxxxxxxxxxxxxx&checksum=yyyyyyyyyyyyyyy
-        urlToRequest = BBB_SERVER_URL
-        urlToRequest += "bigbluebutton/api/getRecordings?meetingID="
-        urlToRequest += urllib.parse.quote_plus(meeting_id)
-        urlToRequest += "&checksum=" + checksum
-        addr = requests.get(urlToRequest)
+def fetch_bbb_recordings_xml(meetings):
+    # Request on BBB/Scalelite server (API) the recordings
+    # of this batch of meetings
+    # See https://docs.bigbluebutton.org/dev/api.html#usage
+    # for checksum and security
+    meetingIDs = ",".join(
+        urllib.parse.quote_plus(meeting.meeting_id) for meeting in meetings
+    )
+    checksumSha1 = GET_RECORDINGS_SHA1.copy()
+    checksumSha1.update(str(meetingIDs + BBB_SECRET_KEY).encode("utf-8"))
+    checksum = checksumSha1.hexdigest()
+    # URL example: https://bbb.univ.fr/bigbluebutton/api/getRecordings?
+    # meetingID=xxxxxxxxxxxxxx,zzzzzzzzzzzzzz&checksum=yyyyyyyyyyyyyyy
+    urlToRequest = BBB_SERVER_URL
+    urlToRequest += "bigbluebutton/api/getRecordings?meetingID="
+    urlToRequest += meetingIDs
+    urlToRequest += "&checksum=" + checksum
+    with bbb_session.get(urlToRequest, stream=True, timeout=BBB_REQUEST_TIMEOUT) as addr:
         print_if_debug(
             "   + Request on URL: " + urlToRequest + ""
             ", status: " + str(addr.status_code)
         )
-        # XML result to parse
-        xmldoc = minidom.parseString(addr.text)
-        returncode = xmldoc.getElementsByTagName("returncode")[0].firstChild.data
+        # XML result, parsed as a stream in the worker thread
+        addr.raw.decode_content = True
+        xmldoc = ET.parse(addr.raw).getroot()
+    return urlToRequest, xmldoc
+
+
+def get_bbb_recording_by_xml(meetings, future, ctx):
+    print_if_debug(" - Check BBB/Scalelite recordings.")
+    try:
+        urlToRequest, xmldoc = future.result()
+        returncode = xmldoc.findtext("returncode")
         # Management of FAILED error (basically error in checksum)
         if returncode == "FAILED":
             err = "Return code = FAILED for: " + urlToRequest
-            err += " => : " + xmldoc.toxml() + ""
-            message_error += err + "\n"
-            html_message_error += "<li>" + err + "</li>"
-        # Actual recordings
-        recordings = xmldoc.getElementsByTagName("recording")
+            err += " => : " + str(xmldoc.findtext("messageKey"))
+            err += " " + str(xmldoc.findtext("message"))
+            ctx.add_error(err)
+        # Dispatch each recording found to the relevant meeting
+        meetingsById = {meeting.internal_meeting_id: meeting for meeting in meetings}
+        recordings = xmldoc.iter("recording")
         for recording in recordings:
-            get_recording(
-                recording,
-                internal_meeting_id,
-                html_message_error,
-                message_error,
-            )
+            get_recording(recording, meetingsById, ctx)
 
     except Exception as e:
         err = (
             "Problem to parse XML recording on the BBB/Scalelite server "
             "or save in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
 
-
-def get_recording(recording, internal_meeting_id, html_message_error, message_error):
+def get_recording(recording, meetings_by_id, ctx):
     try:
         # Get recording informations
-        # meetingID = recording.getElementsByTagName(
-        #    "meetingID")[0].firstChild.data
-        internalMeetingID = recording.getElementsByTagName("internalMeetingID")[
-            0
-        ].firstChild.data
-
-        # We only process the correct recording,
-        # set by the internal_meeting_id
-        print_if_debug(internalMeetingID + " -- " + internal_meeting_id)
-        if internalMeetingID == internal_meeting_id:
-            # Check if the meeting already exists in Pod database
-            oMeeting = Meeting.objects.filter(
-                internal_meeting_id=internal_meeting_id
-            ).first()
-            if oMeeting:
-                get_and_save_recording_url(
-                    recording,
-                    internal_meeting_id,
-                    oMeeting,
-                    html_message_error,
-                    message_error,
-                )
-            else:
-                # Meeting was certainly deleted in Pod database
-                print_if_debug(
-                    "   + WARNING: It seems that this "
-                    "meeting was deleted from Pod database: " + internalMeetingID
-                )
+        # meetingID = recording.findtext("meetingID")
+        internalMeetingID = recording.findtext("internalMeetingID")
+
+        # We only process the recordings of the requested meetings,
+        # set by their internal_meeting_id
+        print_if_debug(internalMeetingID)
+        oMeeting = meetings_by_id.get(internalMeetingID)
+        if oMeeting:
+            get_and_save_recording_url(recording, internalMeetingID, oMeeting, ctx)
+        else:
+            # Recording of a meeting not requested, typically a meeting
+            # already published or deleted in Pod database
+            print_if_debug(
+                "   + WARNING: It seems that this "
+                "meeting was deleted from Pod database: " + internalMeetingID
+            )
 
     except Exception as e:
         err = "Problem to get BBB recording: " + str(e) + ". " + traceback.format_exc()
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
 
-
-def get_and_save_recording_url(
-    recording, internal_meeting_id, oMeeting, html_message_error, message_error
-):
+def get_and_save_recording_url(recording, internal_meeting_id, oMeeting, ctx):
     try:
         # Get recording URL that corresponds to the presentation URL
         # Save this information, if found, in database
@@ -569,18 +816,17 @@ def get_and_save_recording_url(
         # Not other format like "screenshare" or "podcast"
         recording_url = ""
         # Check playback data
-        for playback in recording.getElementsByTagName("playback"):
+        for playback in recording.iter("playback"):
             # Depends on BBB parameters, we can have multiple format
-            for format in playback.getElementsByTagName("format"):
-                type = format.getElementsByTagName("type")[0].firstChild.data
+            for format in playback.iter("format"):
+                info = {child.tag: child.text for child in format}
+                type = info.get("type")
                 # For bbb-recorder, we need URL of presentation format
                 if type == "presentation":
                     # Recording URL is the BBB presentation URL
-                    recording_url = format.getElementsByTagName("url")[0].firstChild.data
+                    recording_url = info.get("url")
                     # We take the first thumbnail found
-                    thumbnail_url = playback.getElementsByTagName("image")[
-                        0
-                    ].firstChild.data
+                    thumbnail_url = playback.findtext(".//image")
 
         if recording_url != "":
             print_if_debug(
@@ -589,9 +835,7 @@ def get_and_save_recording_url(
                 "recording_url: " + recording_url
             )
             # Convert recording_url format (2.0 to 2.3) if necessary
-            recording_url, html_message_error, message_error = convert_format(
-                recording_url, internal_meeting_id, html_message_error, message_error
-            )
+            recording_url = convert_format(recording_url, internal_meeting_id, ctx)
             oMeeting.recording_available = True
             oMeeting.recording_url = recording_url
             oMeeting.thumbnail_url = thumbnail_url
@@ -602,15 +846,11 @@ def get_and_save_recording_url(
             "Problem to get BBB recording url "
             "and save in Pod database: " + str(e) + ". " + traceback.format_exc()
         )
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return html_message_error, message_error
 
-
-def convert_format(recording_url, internal_meeting_id, html_message_error, message_error):
+def convert_format(recording_url, internal_meeting_id, ctx):
     print_if_debug("\n*** Convert recording_url format (if necessary)  ***")
     try:
         # Conversion - if necessary - from
@@ -627,15 +867,13 @@ def convert_format(recording_url, internal_meeting_id, html_message_error, messa
             )
     except Exception as e:
         err = "Problem to convert format: " + str(e) + ". " + traceback.format_exc()
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
 
-    return recording_url, html_message_error, message_error
+    return recording_url
 
 
-def delete_old_meetings(html_message_error, message_error):
+def delete_old_meetings(ctx):
     print_if_debug("\n*** Delete old meetings and BBB users ***")
     try:
         # Delete only old meetings if parameter set
@@ -657,12 +895,8 @@ def delete_old_meetings(html_message_error, message_error):
                 meeting.delete()
     except Exception as e:
         err = "Problem to delete old meetings: " + str(e) + ". " + traceback.format_exc()
-        message_error += err + "\n"
-        html_message_error += "<li>" + err + "</li>"
+        ctx.add_error(err)
         print_if_debug(err)
-        return html_message_error, message_error
-
-    return html_message_error, message_error
 
 
 class Command(BaseCommand):
@@ -678,40 +912,37 @@ class Command(BaseCommand):
         # Activate a fixed locale fr
         translation.activate(LANGUAGE_CODE)
         if options["task"] and options["task"] in self.valid_args:
-            html_message_error = ""
-            message_error = ""
+            ctx = RunContext()
+            # Each phase runs in a single transaction: one commit per
+            # phase, instead of one commit - and one disk flush - per
+            # row written
             # Connect to BBB / Scalelite server to get infos
             # about the current meetings
-            html_message_error, message_error = get_bbb_meetings_by_xml(
-                html_message_error, message_error
-            )
+            with transaction.atomic():
+                get_bbb_meetings_by_xml(ctx)
 
             # Search for recording available for meetings
-            html_message_error, message_error = get_bbb_meetings_recorded(
-                html_message_error, message_error
-            )
+            with transaction.atomic():
+                get_bbb_meetings_recorded(ctx)
 
             # Search to matching BBB users as Pod users
-            html_message_error, message_error = matching_bbb_pod_user(
-                html_message_error, message_error
-            )
+            with transaction.atomic():
+                matching_bbb_pod_user(ctx)
 
             # Check directory to publish video files
-            for root, dirs, files in os.walk(DEFAULT_BBB_PATH):
-                if "logs" in dirs:
-                    dirs.remove("logs")
-                html_message_error, message_error = process_directory(
-                    files, root, html_message_error, message_error
-                )
+            # Not in a transaction: this phase moves files and starts
+            # encodings, a failure must not roll back the videos created
+            process_bbb_path(ctx)
 
             # Delete old meetings and users
-            html_message_error, message_error = delete_old_meetings(
-                html_message_error, message_error
-            )
+            with transaction.atomic():
+                delete_old_meetings(ctx)
 
             # If USE_BBB = True, if there was at least one error,
             # send an email to Pod admins
-            if message_error != "":
+            if ctx.errors_txt:
+                message_error = "\n".join(ctx.errors_txt)
+                html_message_error = "".join(ctx.errors_html)
                 if USE_BBB:
                     print_if_debug(
                         "\n\n*** An email BBB job [Error(s) "
@@ -20,9 +20,11 @@ class BBB_Meeting(models.Model):
         _("Meeting id"), max_length=200, help_text=_("Id of the BBB meeting.")
     )
     # Internal meeting id for the BBB session
+    # Unique: it is the key used to find a meeting at each sync
     internal_meeting_id = models.CharField(
         _("Internal meeting id"),
         max_length=200,
+        unique=True,
         help_text=_("Internal id of the BBB meeting."),
     )
     # Meeting name for the BBB session
@@ -163,6 +165,8 @@ class Attendee(models.Model):
         verbose_name = _("Attendee")
         verbose_name_plural = _("Attendees")
         ordering = ["full_name"]
+        # Index useful for the BBB users search made at each sync
+        indexes = [models.Index(fields=["meeting", "full_name"])]
 
 
 # Management of BigBlueButton sessions for live